@@ -2,9 +2,10 @@ from django.contrib import admin
 
 # Register your models here.
 
-from .models import Room, Topic, Message, User
+from .models import Room, Topic, Message, User, UserProfileSummary
 
 admin.site.register(User)
 admin.site.register(Room)
 admin.site.register(Topic)
-admin.site.register(Message)
\ No newline at end of file
+admin.site.register(Message)
+admin.site.register(UserProfileSummary)
@@ -0,0 +1,54 @@
+# Write-time rendering of message bodies and room welcome messages.
+
+import re
+from functools import lru_cache
+
+from django.core.exceptions import ValidationError
+from django.utils.html import urlize
+from django.utils.text import normalize_newlines
+
+
+def render_body(body):
+    """Escape a message body, link URLs/emails and keep its line breaks.
+
+    The result is stored on Message.body_html so templates don't have to do
+    this on every render.
+    """
+    html = urlize(body or '', nofollow=True, autoescape=True)
+    return normalize_newlines(html).replace('\n', '<br>')
+
+
+# {user} and {room} are the only placeholders; other braces are plain text,
+# the same as the old str.replace() based greeting
+PLACEHOLDER = re.compile(r'\{(user|room)\}')
+UNKNOWN_PLACEHOLDER = re.compile(r'\{(\w+)\}')
+
+
+def validate_welcome_message(text):
+    unknown = {name for name in UNKNOWN_PLACEHOLDER.findall(text) if name not in ('user', 'room')}
+    if unknown:
+        raise ValidationError(
+            'Unknown placeholder(s) %(names)s, only {user} and {room} can be used.',
+            params={'names': ', '.join('{%s}' % name for name in sorted(unknown))},
+        )
+
+
+class WelcomeTemplate:
+    # Pre-split into literal text and placeholder names so rendering is a join.
+    # Room.welcome_message is checked by validate_welcome_message when edited;
+    # anything that slipped past it is simply left as text here.
+
+    def __init__(self, text):
+        self.parts = PLACEHOLDER.split(text)
+
+    def render(self, user, room):
+        values = {'user': user, 'room': room}
+        # re.split puts captured placeholder names at the odd indexes
+        return ''.join(
+            values[part] if i % 2 else part for i, part in enumerate(self.parts)
+        )
+
+
+@lru_cache(maxsize=1024)
+def compile_welcome(text):
+    return WelcomeTemplate(text)
@@ -0,0 +1,98 @@
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models.signals import post_save
+
+from base import sharding
+from base.models import Message
+from base.signals import message_saved
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark concurrent message writes against 1..N temporary SQLite shards. '
+        'Uses scratch databases, the configured ones are not touched.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+        parser.add_argument('--writers', type=int, default=8, help='Concurrent writer threads')
+        parser.add_argument('--messages', type=int, default=400, help='Messages per writer')
+        parser.add_argument('--rooms', type=int, default=256)
+
+    def handle(self, *args, **options):
+        # Profile summaries live in the default database; keep them out of the
+        # numbers so only the shard writes are measured
+        post_save.disconnect(message_saved, sender=Message)
+        try:
+            self.benchmark(options)
+        finally:
+            post_save.connect(message_saved, sender=Message)
+
+    def benchmark(self, options):
+        baseline = None
+        for shard_count in options['shards']:
+            workdir = Path(tempfile.mkdtemp(prefix='studybud-shards-'))
+            try:
+                aliases = self.create_shards(workdir, shard_count)
+                rate = self.run(aliases, options)
+            finally:
+                for alias in aliases:
+                    connections[alias].close()
+                shutil.rmtree(workdir, ignore_errors=True)
+
+            baseline = baseline or rate
+            self.stdout.write(
+                f'{shard_count:>3} shard(s): {rate:10.0f} messages/s  ({rate / baseline:.2f}x)'
+            )
+
+    def create_shards(self, workdir, shard_count):
+        aliases = [f'bench_messages_{shard_count}_{i}' for i in range(shard_count)]
+        databases = dict(connections.settings)
+        for alias in aliases:
+            databases[alias] = {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': workdir / f'{alias}.sqlite3',
+                'OPTIONS': {'timeout': 60},
+            }
+        connections.settings.update(connections.configure_settings(databases))
+
+        for alias in aliases:
+            with connections[alias].schema_editor() as editor:
+                editor.create_model(Message)
+        return aliases
+
+    def run(self, aliases, options):
+        writers, per_writer, rooms = options['writers'], options['messages'], options['rooms']
+        errors = []
+
+        def write(writer):
+            try:
+                for i in range(per_writer):
+                    room_id = (writer * per_writer + i) % rooms + 1
+                    # One autocommit insert per message, like the room view
+                    Message.objects.using(sharding.shard_for_room(room_id, aliases)).create(
+                        user_id=writer + 1, room_id=room_id, body=f'benchmark message {i}'
+                    )
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                for alias in aliases:
+                    connections[alias].close()
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(writers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        if errors:
+            raise errors[0]
+        return writers * per_writer / elapsed
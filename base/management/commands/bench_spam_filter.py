@@ -0,0 +1,106 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from base.spam import Fingerprint, FingerprintIndex, scopes_for
+
+
+WORDS = (
+    'django python react study group exam notes lecture homework question '
+    'answer project deadline room topic help anyone know how does this work '
+    'thanks great idea meet tomorrow library code review bug fix deploy'
+).split()
+
+FLOOD = 'join my discord server for free exam answers and cheap homework help now'
+
+# Legitimate messages that differ from each other by a word or two, the kind
+# of traffic a near-duplicate filter must let through
+NEAR_MISS = [
+    'can someone help me with question {n} of the homework',
+    'does anyone have the {thing} from the last lecture',
+    'lets meet at the library at {n} pm tomorrow',
+    'is the deadline for project {n} still on {day}',
+    'i pushed a fix for bug {n} can someone review it',
+    'which chapter covers {thing} for the exam on {day}',
+]
+THINGS = ['notes', 'slides', 'recording', 'summary', 'exercises', 'reading']
+DAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday']
+SHORT = ['ok', 'thanks', 'yes', 'same here', 'lol', 'good point', 'agreed']
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the duplicate/spam filter against a synthetic message flood'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=20000)
+        parser.add_argument('--rate', type=float, default=20, help='Messages per second across all rooms')
+        parser.add_argument('--rooms', type=int, default=50)
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--flood-ratio', type=float, default=0.3,
+                            help='Share of messages that are copies or light edits of a flood text')
+        parser.add_argument('--near-miss-ratio', type=float, default=0.2,
+                            help='Share of legitimate messages that are near-misses of each other')
+        parser.add_argument('--short-ratio', type=float, default=0.1,
+                            help='Share of short replies ("ok", "thanks")')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        # A realistic spread of vocabulary; the seed words keep it readable
+        vocabulary = WORDS + [
+            ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9)))
+            for _ in range(3000)
+        ]
+        index = FingerprintIndex()
+        flood_words = FLOOD.split()
+
+        timings = []
+        sent = dict.fromkeys(['flood', 'flood-edited', 'near-miss', 'short', 'random'], 0)
+        rejected = dict(sent)
+        now = 0.0
+
+        for _ in range(options['messages']):
+            now += 1 / options['rate']
+            user = rng.randrange(options['users'])
+            room = rng.randrange(options['rooms'])
+
+            roll = rng.random()
+            if roll < options['flood_ratio']:
+                kind = 'flood'
+                words = list(flood_words)
+                # Light edits so only the MinHash sketch, not the exact hash, matches
+                if rng.random() < 0.5:
+                    kind = 'flood-edited'
+                    words[rng.randrange(len(words))] = rng.choice(vocabulary)
+                body = ' '.join(words)
+            elif roll < options['flood_ratio'] + options['near_miss_ratio']:
+                kind = 'near-miss'
+                body = rng.choice(NEAR_MISS).format(
+                    n=rng.randint(1, 20), thing=rng.choice(THINGS), day=rng.choice(DAYS)
+                )
+            elif roll < options['flood_ratio'] + options['near_miss_ratio'] + options['short_ratio']:
+                kind = 'short'
+                body = rng.choice(SHORT)
+            else:
+                kind = 'random'
+                body = ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(2, 20)))
+
+            start = time.perf_counter()
+            fingerprint = Fingerprint(body)
+            exact_scopes, near_scopes = scopes_for(fingerprint, user, room)
+            was_rejected = index.check(fingerprint, exact_scopes, near_scopes, now=now)
+            timings.append(time.perf_counter() - start)
+
+            sent[kind] += 1
+            rejected[kind] += was_rejected
+
+        timings.sort()
+        micro = 1_000_000
+        self.stdout.write(f"messages:           {options['messages']}")
+        self.stdout.write(f"mean:               {statistics.mean(timings) * micro:.1f} us")
+        self.stdout.write(f"p50:                {timings[len(timings) // 2] * micro:.1f} us")
+        self.stdout.write(f"p99:                {timings[int(len(timings) * 0.99)] * micro:.1f} us")
+        for kind in sent:
+            self.stdout.write(f"{kind + ' rejected:':<20}{rejected[kind]}/{sent[kind]}")
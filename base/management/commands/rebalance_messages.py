@@ -0,0 +1,84 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from base import sharding
+from base.models import Message, UserProfileSummary
+
+
+class Command(BaseCommand):
+    help = (
+        'Move messages into the shard their room belongs to. Run after enabling '
+        'MESSAGE_SHARDS or changing the number of shards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would move')
+
+    def handle(self, *args, **options):
+        aliases = sharding.shards()
+        if not aliases:
+            raise CommandError('Sharding is disabled, set MESSAGE_SHARDS first.')
+
+        self.rebalance(aliases, options)
+
+    def rebalance(self, aliases, options):
+        total = 0
+        # Messages written before sharding was enabled sit in default
+        for source in ['default'] + aliases:
+            room_ids = Message.objects.using(source).order_by().values_list('room_id', flat=True).distinct()
+            for room_id in list(room_ids):
+                target = sharding.shard_for_room(room_id, aliases)
+                if target == source:
+                    continue
+                moved = self.move_room(room_id, source, target, options['batch_size'], options['dry_run'])
+                total += moved
+                self.stdout.write(f'room {room_id}: {moved} messages {source} -> {target}')
+
+        verb = 'Would move' if options['dry_run'] else 'Moved'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {total} messages'))
+
+    def move_room(self, room_id, source, target, batch_size, dry_run):
+        messages = Message.objects.using(source).filter(room_id=room_id).order_by('id')
+        if dry_run:
+            return messages.count()
+
+        moved = 0
+        while True:
+            batch = list(messages[:batch_size])
+            if not batch:
+                return moved
+
+            old_ids = [message.id for message in batch]
+            user_ids = {message.user_id for message in batch}
+            # A run that failed between copying and deleting left copies on
+            # the target already; those rows are only deleted from the source
+            copied = set(
+                Message.objects.using(target)
+                .filter(room_id=room_id, created__in=[message.created for message in batch])
+                .values_list('user_id', 'created')
+            )
+            batch = [message for message in batch if (message.user_id, message.created) not in copied]
+
+            # Moved messages get new ids from the target's range; bulk_create
+            # also stamps auto_now fields, so the originals are put back after
+            timestamps = [(message.created, message.updated) for message in batch]
+            for message in batch:
+                message.pk = None
+
+            with transaction.atomic(using=target):
+                Message.objects.using(target).bulk_create(batch)
+                for message, (created, updated) in zip(batch, timestamps):
+                    message.created, message.updated = created, updated
+                Message.objects.using(target).bulk_update(batch, ['created', 'updated'])
+
+            # Only once the copies are committed: a failure from here on
+            # leaves copies the next run skips instead of losing messages. A queryset
+            # delete leaves the summaries' message counts alone, the moved
+            # messages still exist; only their ids changed.
+            Message.objects.using(source).filter(id__in=old_ids).delete()
+
+            for summary in UserProfileSummary.objects.filter(user_id__in=user_ids):
+                summary.refresh_recent_messages()
+                summary.save(update_fields=['recent_messages', 'updated'])
+            moved += len(old_ids)
@@ -0,0 +1,64 @@
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+from base.warmup import warm_up
+
+
+class Command(BaseCommand):
+    help = (
+        'Precompile templates, load URL patterns and open database connections. '
+        'With --measure, compare first-request latency of cold and warmed-up processes.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--measure', action='store_true',
+                            help='Time the first request in fresh cold and warm processes')
+        parser.add_argument('--path', default='/login/', help='Page requested by --measure')
+        parser.add_argument('--runs', type=int, default=5)
+        # Used internally by --measure: serve one request in this process
+        parser.add_argument('--probe', action='store_true', help='Time a single first request and exit')
+        parser.add_argument('--cold', action='store_true', help='With --probe, skip the warm-up')
+
+    def handle(self, *args, **options):
+        if options['probe']:
+            return self.probe(options)
+        if options['measure']:
+            return self.measure(options)
+
+        for name, count, seconds in warm_up():
+            self.stdout.write(f'{name:<10} {count:>5}  {seconds * 1000:8.1f} ms')
+
+    def probe(self, options):
+        if not options['cold']:
+            warm_up()
+
+        # Django only allows localhost-ish hosts while DEBUG is on
+        host = (settings.ALLOWED_HOSTS or ['localhost'])[0].lstrip('.')
+        client = Client(SERVER_NAME='localhost' if host == '*' else host)
+        start = time.perf_counter()
+        response = client.get(options['path'])
+        elapsed = time.perf_counter() - start
+        if response.status_code >= 400:
+            raise CommandError(f"{options['path']} returned {response.status_code}")
+        self.stdout.write(f'{elapsed * 1000:.3f}')
+
+    def measure(self, options):
+        results = {}
+        for mode in ('cold', 'warm'):
+            command = [sys.executable, sys.argv[0], 'warmup', '--probe', '--path', options['path']]
+            if mode == 'cold':
+                command.append('--cold')
+            samples = []
+            for _ in range(options['runs']):
+                output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+                samples.append(float(output.strip().splitlines()[-1]))
+            results[mode] = statistics.median(samples)
+            self.stdout.write(f"{mode:<5} first request to {options['path']}: {results[mode]:8.1f} ms (median of {options['runs']})")
+
+        self.stdout.write(f"warm-up saves {results['cold'] - results['warm']:.1f} ms on the first request")
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.6 on 2026-10-19 10:12
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0004_user_avatar'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserProfileSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rooms_hosted', models.PositiveIntegerField(default=0)),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('top_topics', models.JSONField(blank=True, default=list)),
+                ('recent_messages', models.JSONField(blank=True, default=list)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='summary', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
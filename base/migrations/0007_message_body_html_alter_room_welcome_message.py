@@ -0,0 +1,39 @@
+# Generated by Django 5.1.6 on 2026-10-19 13:05
+
+import base.formatting
+from django.db import migrations, models
+
+
+def render_existing_bodies(apps, schema_editor):
+    Message = apps.get_model('base', 'Message')
+    messages = Message.objects.using(schema_editor.connection.alias).filter(body_html='')
+    batch = []
+    for message in messages.iterator(chunk_size=1000):
+        message.body_html = base.formatting.render_body(message.body)
+        batch.append(message)
+        if len(batch) == 1000:
+            Message.objects.using(schema_editor.connection.alias).bulk_update(batch, ['body_html'])
+            batch = []
+    Message.objects.using(schema_editor.connection.alias).bulk_update(batch, ['body_html'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0006_alter_message_room_alter_message_user'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='body_html',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='room',
+            name='welcome_message',
+            field=models.TextField(default='Welcome {user} to {room}!', validators=[base.formatting.validate_welcome_message]),
+        ),
+        # The hint lets the message shards (see base/routers.py) run it too
+        migrations.RunPython(render_existing_bodies, migrations.RunPython.noop, hints={'model_name': 'message'}),
+    ]
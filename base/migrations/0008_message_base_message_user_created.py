@@ -0,0 +1,17 @@
+# Generated by Django 5.1.6 on 2026-10-20 09:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0007_message_body_html_alter_room_welcome_message'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['user', '-created'], name='base_message_user_created'),
+        ),
+    ]
@@ -1,9 +1,12 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
 
 # Create your models here.
 # Where we create our database tables
 
 from django.contrib.auth.models import AbstractUser
+from django.utils.safestring import mark_safe
+
+from .formatting import compile_welcome, render_body, validate_welcome_message
 
 
 class User(AbstractUser):
@@ -31,7 +34,7 @@ class Room(models.Model):
     # participants = models.ManyToManyField('User')
 
     # Rahul
-    welcome_message = models.TextField(default="Welcome {user} to {room}!")
+    welcome_message = models.TextField(default="Welcome {user} to {room}!", validators=[validate_welcome_message])
     # end
     
     participants = models.ManyToManyField(User, related_name="participants", blank=True)
@@ -44,11 +47,48 @@ class Room(models.Model):
         
     def __str__(self):
         return self.name
+
+    def render_welcome(self, user):
+        # Compiled once per distinct welcome text, shared by every greeting
+        return compile_welcome(self.welcome_message).render(user.username, self.name)
     
+class MessageQuerySet(models.QuerySet):
+    def create(self, **kwargs):
+        # Save without forcing an alias so the router can place the message by
+        # its room (see base/sharding.py); QuerySet.create would pin self.db.
+        obj = self.model(**kwargs)
+        self._for_write = True
+        obj.save(force_insert=True, using=self._db)
+        return obj
+
+    # body_html is rendered from body by Message.save(); writes that skip
+    # save() render it here or have to pass it along themselves, otherwise
+    # pages would keep showing the old text
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.body_html = render_body(obj.body)
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        if 'body' in fields and 'body_html' not in fields:
+            raise ValueError("bulk_update() of Message.body must include 'body_html' as well.")
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+    def update(self, **kwargs):
+        if 'body' in kwargs and 'body_html' not in kwargs:
+            raise ValueError('update() of Message.body must set body_html=render_body(body) as well.')
+        return super().update(**kwargs)
+
+
 class Message(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    room = models.ForeignKey(Room, on_delete=models.CASCADE)
+    # No database-level constraints: with sharding enabled messages live in a
+    # different database from their users and rooms
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, db_constraint=False)
     body = models.TextField()
+    body_html = models.TextField(blank=True, editable=False)  # escaped/linked body, see render_body
 
     # Rahul
     is_bot = models.BooleanField(default=False)
@@ -56,10 +96,124 @@ class Message(models.Model):
 
     updated = models.DateTimeField(auto_now=True)
     created = models.DateTimeField(auto_now_add=True)
+
+    objects = MessageQuerySet.as_manager()
     
     class Meta:
         ordering = ['-updated', '-created']
+        # Profile summaries read a user's latest messages on every post
+        indexes = [models.Index(fields=['user', '-created'], name='base_message_user_created')]
         
     def __str__(self):
         return self.body[:50]
-    
\ No newline at end of file
+
+    def save(self, *args, **kwargs):
+        self.body_html = render_body(self.body)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'body' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'body_html'}
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        # Only deletes of a single message update the author's summary here:
+        # bulk and cascading deletes don't go through Model.delete, and
+        # base/signals.py recounts once per author when a room goes
+        pk, user_id = self.pk, self.user_id
+        result = super().delete(*args, **kwargs)
+        UserProfileSummary.message_removed(user_id, pk)
+        return result
+
+    @property
+    def rendered_body(self):
+        # Kept in step with body by save() and MessageQuerySet; rows from
+        # before body_html existed were rendered by migration 0007
+        return mark_safe(self.body_html)
+    
+
+class UserProfileSummary(models.Model):
+    # Denormalized numbers for the profile page, kept up to date by the
+    # signal handlers in base/signals.py and Message.delete so userProfile
+    # never has to walk a user's whole history.
+    TOP_TOPICS = 5
+    RECENT_MESSAGES = 5
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="summary")
+    rooms_hosted = models.PositiveIntegerField(default=0)
+    message_count = models.PositiveIntegerField(default=0)
+    top_topics = models.JSONField(default=list, blank=True)  # topic ids, most hosted first
+    recent_messages = models.JSONField(default=list, blank=True)  # message ids, newest first
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Summary for {self.user}"
+
+    @classmethod
+    def for_user(cls, user):
+        summary = cls.objects.filter(user=user).first()
+        if summary is None:
+            summary = cls(user=user)
+            try:
+                with transaction.atomic():
+                    summary.rebuild()
+            except IntegrityError:
+                # A concurrent first view of the same profile built it first
+                summary = cls.objects.get(user=user)
+        return summary
+
+    def refresh_rooms(self):
+        rooms = Room.objects.filter(host_id=self.user_id)
+        self.rooms_hosted = rooms.count()
+        self.top_topics = list(
+            rooms.filter(topic__isnull=False)
+            .values('topic')
+            .annotate(total=models.Count('id'))
+            .order_by('-total', 'topic')
+            .values_list('topic', flat=True)[:self.TOP_TOPICS]
+        )
+
+    def refresh_recent_messages(self):
+        from . import sharding
+
+        recent = sharding.scatter(
+            Message.objects.filter(user_id=self.user_id).only('id', 'created').order_by('-created', '-id'),
+            limit=self.RECENT_MESSAGES,
+        )
+        self.recent_messages = [message.id for message in recent]
+
+    def refresh_messages(self):
+        from . import sharding
+
+        self.message_count = sharding.count(Message.objects.filter(user_id=self.user_id))
+        self.refresh_recent_messages()
+
+    def rebuild(self):
+        self.refresh_rooms()
+        self.refresh_messages()
+        self.save()
+
+    # The row is locked while a message is added or removed so concurrent
+    # writes by the same user can't overwrite each other's recent_messages
+
+    @classmethod
+    def message_added(cls, user_id, message_id):
+        with transaction.atomic():
+            summary = cls.objects.select_for_update().filter(user_id=user_id).first()
+            if summary is None:
+                return
+            summary.message_count = models.F('message_count') + 1
+            summary.recent_messages = [message_id, *summary.recent_messages][:cls.RECENT_MESSAGES]
+            summary.save(update_fields=['message_count', 'recent_messages', 'updated'])
+
+    @classmethod
+    def message_removed(cls, user_id, message_id):
+        with transaction.atomic():
+            summary = cls.objects.select_for_update().filter(user_id=user_id).first()
+            if summary is None:
+                return
+            summary.message_count = models.F('message_count') - 1
+            update_fields = ['message_count', 'updated']
+            # Only a message still on the profile needs the list re-read
+            if message_id in summary.recent_messages:
+                summary.refresh_recent_messages()
+                update_fields.append('recent_messages')
+            summary.save(update_fields=update_fields)
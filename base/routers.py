@@ -0,0 +1,36 @@
+from . import sharding
+from .models import Message, Room
+
+
+class MessageShardRouter:
+    # Enabled through settings.DATABASE_ROUTERS when MESSAGE_SHARDS is set.
+    # Messages go to the shard of their room, everything else stays on default.
+
+    def _route(self, model, hints):
+        if model is not Message:
+            return 'default'
+
+        instance = hints.get('instance')
+        if isinstance(instance, Message):
+            if not instance._state.adding and instance._state.db:
+                return instance._state.db
+            return sharding.shard_for_room(instance.room_id)
+        if isinstance(instance, Room):
+            return sharding.shard_for_room(instance.pk)
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._route(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if isinstance(obj1, Message) or isinstance(obj2, Message):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in sharding.shards():
+            return app_label == 'base' and model_name == 'message'
+        return None
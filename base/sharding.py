@@ -0,0 +1,206 @@
+# Optional horizontal partitioning of Message rows by room.
+#
+# With settings.MESSAGE_SHARDS set to a list of database aliases, every
+# message lives in the shard its room hashes to and MessageShardRouter
+# (base/routers.py) sends room-scoped queries such as room.message_set there.
+# Views that span rooms use scatter()/count()/get_message() below, which fan
+# the query out to every shard and merge the results in Python.
+#
+# Messages written before sharding was enabled stay in `default` until
+# `manage.py rebalance_messages` moves them; until then every read helper
+# also looks there, so nothing disappears in between.
+#
+# With MESSAGE_SHARDS empty every helper falls back to the plain single
+# database query, so the rest of the code doesn't need to know either way.
+
+from operator import attrgetter
+
+from django.conf import settings
+from django.db import connections
+from django.db.models.signals import post_migrate, pre_delete
+from django.dispatch import receiver
+
+from .models import Message, User
+
+
+# Each shard hands out message ids from its own range so ids stay unique
+# across shards; rebalance_messages gives moved rows a new id in the target's
+# range, so the id of a sharded message also tells which shard holds it.
+ID_RANGE_BITS = 40
+
+
+def shards():
+    return list(getattr(settings, 'MESSAGE_SHARDS', []))
+
+
+def enabled():
+    return bool(shards())
+
+
+_default_drained = False
+
+
+def has_unrebalanced_messages():
+    # Once default is seen empty it stays that way (the router never writes
+    # messages there), so the check stops costing a query
+    global _default_drained
+    if not _default_drained:
+        _default_drained = not Message.objects.using('default').exists()
+    return not _default_drained
+
+
+def read_aliases():
+    """Every shard, plus default while it still holds unrebalanced messages."""
+    aliases = shards()
+    if aliases and has_unrebalanced_messages():
+        aliases.append('default')
+    return aliases
+
+
+def room_aliases(room_id):
+    """Databases holding messages of one room; empty when sharding is off."""
+    if not enabled():
+        return []
+    aliases = [shard_for_room(room_id)]
+    if has_unrebalanced_messages():
+        aliases.append('default')
+    return aliases
+
+
+def jump_hash(key, buckets):
+    # Jump consistent hash (Lamping & Veach): growing from n to n + 1 shards
+    # only moves 1 / (n + 1) of the rooms.
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def shard_for_room(room_id, aliases=None):
+    aliases = shards() if aliases is None else aliases
+    if not aliases:
+        return 'default'
+    return aliases[jump_hash(int(room_id), len(aliases))]
+
+
+def _sort(results, ordering):
+    # Stable sorts from the last ordering field to the first give the same
+    # order the database would have produced for a single table.
+    for field in reversed(ordering):
+        descending = field.startswith('-')
+        results.sort(key=attrgetter(field.lstrip('-')), reverse=descending)
+    return results
+
+
+def _per_shard(queryset):
+    # Related rows (users, rooms) live in the default database, so joins
+    # can't follow messages into a shard; fetch them separately instead.
+    related = queryset.query.select_related
+    if isinstance(related, dict):
+        queryset = queryset.select_related(None).prefetch_related(*related)
+    return queryset
+
+
+def scatter(queryset, limit=None, aliases=None):
+    """Run a Message queryset on every shard and merge the ordered results.
+
+    Returns the queryset itself (sliced to `limit`) when sharding is off.
+    """
+    aliases = read_aliases() if aliases is None else aliases
+    if not aliases:
+        return queryset if limit is None else queryset[:limit]
+
+    queryset = _per_shard(queryset)
+    results = []
+    for alias in aliases:
+        shard_qs = queryset.using(alias)
+        results.extend(shard_qs if limit is None else shard_qs[:limit])
+
+    ordering = queryset.query.order_by or queryset.model._meta.ordering
+    _sort(results, ordering)
+    return results if limit is None else results[:limit]
+
+
+def messages_for_rooms(room_ids, limit=None):
+    """Messages posted in any of `room_ids`, querying only the shards involved."""
+    aliases = shards()
+    if not aliases:
+        return scatter(Message.objects.filter(room_id__in=room_ids), limit)
+
+    room_ids = list(room_ids)
+    by_shard = {}
+    for room_id in room_ids:
+        by_shard.setdefault(shard_for_room(room_id, aliases), []).append(room_id)
+    if has_unrebalanced_messages():
+        by_shard['default'] = room_ids
+
+    results = []
+    for alias, ids in by_shard.items():
+        results.extend(scatter(Message.objects.filter(room_id__in=ids), limit, aliases=[alias]))
+
+    _sort(results, Message._meta.ordering)
+    return results if limit is None else results[:limit]
+
+
+def count(queryset):
+    aliases = read_aliases()
+    if not aliases:
+        return queryset.count()
+    return sum(queryset.using(alias).count() for alias in aliases)
+
+
+def get_message(pk):
+    """Message.objects.get(pk=pk) across shards; raises Message.DoesNotExist."""
+    aliases = read_aliases()
+    if not aliases:
+        return Message.objects.get(pk=pk)
+
+    # Try the shard owning the id range first, the others (and default) only
+    # cover rows that haven't been rebalanced yet
+    pk = int(pk)
+    home = (pk >> ID_RANGE_BITS) - 1
+    if 0 <= home < len(aliases):
+        aliases.insert(0, aliases.pop(home))
+
+    for alias in aliases:
+        message = Message.objects.using(alias).filter(pk=pk).first()
+        if message is not None:
+            return message
+    raise Message.DoesNotExist('Message matching query does not exist.')
+
+
+def delete_room_messages(room):
+    # The ORM cascade only sees the room's own database. Called from the
+    # Room pre_delete handler in base/signals.py, after it noted the authors.
+    if enabled():
+        Message.objects.using(shard_for_room(room.pk)).filter(room_id=room.pk).delete()
+
+
+@receiver(pre_delete, sender=User)
+def delete_user_messages(sender, instance, **kwargs):
+    for alias in shards():
+        Message.objects.using(alias).filter(user_id=instance.pk).delete()
+
+
+@receiver(post_migrate)
+def reserve_id_range(sender, using, **kwargs):
+    aliases = shards()
+    if sender.name != 'base' or using not in aliases:
+        return
+
+    start = (aliases.index(using) + 1) << ID_RANGE_BITS
+    connection = connections[using]
+    table = Message._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, %s) WHERE name = %s", [start, table])
+            if not cursor.rowcount:
+                cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)", [table, start])
+        elif connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                "GREATEST(%s, (SELECT COALESCE(MAX(id), 0) FROM " + connection.ops.quote_name(table) + ")))",
+                [table, start],
+            )
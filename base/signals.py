@@ -0,0 +1,68 @@
+# Keep UserProfileSummary in step with Room and Message writes.
+#
+# Summaries are created lazily by UserProfileSummary.for_user, so every
+# handler here only touches a summary that already exists.
+#
+# There is deliberately no delete signal for Message: any receiver makes the
+# ORM load and delete a room's messages one by one. Single deletes are
+# handled by Message.delete, a room's messages are recounted once per author.
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import sharding
+from .models import Message, Room, UserProfileSummary
+
+
+def _refresh_rooms(user_id):
+    if user_id is None:
+        return
+    summary = UserProfileSummary.objects.filter(user_id=user_id).first()
+    if summary is not None:
+        summary.refresh_rooms()
+        summary.save(update_fields=['rooms_hosted', 'top_topics', 'updated'])
+
+
+@receiver(pre_save, sender=Room)
+def remember_previous_host(sender, instance, **kwargs):
+    instance._previous_host_id = None
+    if instance.pk is not None:
+        instance._previous_host_id = (
+            Room.objects.filter(pk=instance.pk).values_list('host_id', flat=True).first()
+        )
+
+
+@receiver(post_save, sender=Room)
+def room_saved(sender, instance, **kwargs):
+    _refresh_rooms(instance.host_id)
+    previous = getattr(instance, '_previous_host_id', None)
+    if previous != instance.host_id:
+        _refresh_rooms(previous)
+
+
+@receiver(pre_delete, sender=Room)
+def room_deleting(sender, instance, **kwargs):
+    # Note the authors first, their messages are deleted in bulk from here on
+    authors = Message.objects.filter(room_id=instance.pk).order_by().values_list('user_id', flat=True).distinct()
+    aliases = sharding.room_aliases(instance.pk) or [None]
+    instance._message_user_ids = {user_id for alias in aliases for user_id in authors.using(alias)}
+    sharding.delete_room_messages(instance)
+
+
+@receiver(post_delete, sender=Room)
+def room_deleted(sender, instance, **kwargs):
+    _refresh_rooms(instance.host_id)
+    user_ids = getattr(instance, '_message_user_ids', ())
+    if not user_ids:
+        return
+    with transaction.atomic():
+        for summary in UserProfileSummary.objects.select_for_update().filter(user_id__in=user_ids):
+            summary.refresh_messages()
+            summary.save(update_fields=['message_count', 'recent_messages', 'updated'])
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, **kwargs):
+    if created:
+        UserProfileSummary.message_added(instance.user_id, instance.id)
@@ -0,0 +1,189 @@
+# Duplicate / flood detection for incoming messages.
+#
+# Every body is reduced to two fingerprints before it reaches the database:
+#   - an exact hash of the normalized text (case, punctuation and whitespace
+#     folded away), which catches copy-pasted floods
+#   - a MinHash sketch of the words and word pairs, which catches
+#     near-duplicates (the same flood text lightly edited) by their estimated
+#     Jaccard similarity
+#
+# Recent fingerprints are kept in memory in bounded, time-windowed buckets
+# ("scopes"), see scopes_for(). Buckets themselves are evicted
+# least-recently-used so the index never grows past SPAM_FILTER['MAX_SCOPES'].
+#
+# Near-duplicates are only looked for among different people's messages in
+# one room, and only rejected once the text has been seen NEAR_HITS times:
+# ordinary follow-ups ("question 3" / "question 4") are nearly as similar as
+# a reworded flood, so a single similar message is never enough.
+
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+
+DEFAULTS = {
+    'ENABLED': True,
+    'WINDOW_SECONDS': 120,   # how long a fingerprint is remembered
+    'PER_SCOPE': 50,         # fingerprints kept per scope
+    'MAX_SCOPES': 10000,     # scopes tracked before LRU eviction
+    'MIN_SIMILARITY': 0.78,  # estimated Jaccard similarity of a near-duplicate
+    'NEAR_HITS': 2,          # similar recent messages needed to reject in a room
+    'MIN_TOKENS': 6,         # shorter bodies ("ok", "thanks") are never compared across rooms or users
+}
+
+_PUNCTUATION = re.compile(r'[^\w\s]+', re.UNICODE)
+_WHITESPACE = re.compile(r'\s+')
+SKETCH_SIZE = 32
+
+
+def get_setting(name):
+    return getattr(settings, 'SPAM_FILTER', {}).get(name, DEFAULTS[name])
+
+
+def normalize(body):
+    body = _PUNCTUATION.sub(' ', (body or '').lower())
+    return _WHITESPACE.sub(' ', body).strip()
+
+
+def exact_hash(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest()
+
+
+def _feature_hash(feature):
+    return int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def minhash(tokens, size=SKETCH_SIZE):
+    # Bottom-k MinHash over words and adjacent word pairs: editing one word of
+    # a 13 word message still leaves ~80% of the features in common, while
+    # swapping a word in a shorter follow-up drops it below MIN_SIMILARITY.
+    features = set(tokens)
+    features.update(f'{a} {b}' for a, b in zip(tokens, tokens[1:]))
+    return frozenset(sorted(map(_feature_hash, features))[:size])
+
+
+def similarity(a, b, size=SKETCH_SIZE):
+    """Estimated Jaccard similarity of the texts behind two sketches."""
+    if len(a) < size and len(b) < size:
+        # Both sketches hold every feature, so this is exact
+        return len(a & b) / len(a | b)
+    union = sorted(a | b)[:size]
+    return sum(1 for h in union if h in a and h in b) / len(union)
+
+
+class Fingerprint:
+    __slots__ = ('exact', 'sketch', 'tokens')
+
+    def __init__(self, body):
+        text = normalize(body)
+        tokens = text.split(' ') if text else []
+        self.exact = exact_hash(text)
+        self.tokens = len(tokens)
+        # Near-duplicate matching on very short bodies flags ordinary chatter.
+        self.sketch = minhash(tokens) if self.tokens >= get_setting('MIN_TOKENS') else None
+
+
+class FingerprintIndex:
+    """Bounded, time-windowed fingerprint buckets keyed by scope.
+
+    A scope is any hashable, e.g. ('room', 3) or ('user', 7, 3).
+    """
+
+    def __init__(self, window=None, per_scope=None, max_scopes=None, min_similarity=None, near_hits=None):
+        self.window = window if window is not None else get_setting('WINDOW_SECONDS')
+        self.per_scope = per_scope if per_scope is not None else get_setting('PER_SCOPE')
+        self.max_scopes = max_scopes if max_scopes is not None else get_setting('MAX_SCOPES')
+        self.min_similarity = min_similarity if min_similarity is not None else get_setting('MIN_SIMILARITY')
+        self.near_hits = near_hits if near_hits is not None else get_setting('NEAR_HITS')
+        self._scopes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bucket(self, scope, now):
+        bucket = self._scopes.get(scope)
+        if bucket is None:
+            bucket = self._scopes[scope] = deque(maxlen=self.per_scope)
+            if len(self._scopes) > self.max_scopes:
+                self._scopes.popitem(last=False)
+        else:
+            self._scopes.move_to_end(scope)
+
+        cutoff = now - self.window
+        while bucket and bucket[0][0] < cutoff:
+            bucket.popleft()
+        return bucket
+
+    def _exact_match(self, bucket, fingerprint):
+        return any(exact == fingerprint.exact for _, exact, _ in bucket)
+
+    def _near_hits(self, bucket, fingerprint):
+        if fingerprint.sketch is None:
+            return 0
+        return sum(
+            1 for _, exact, sketch in bucket
+            if exact == fingerprint.exact
+            or (sketch is not None and similarity(sketch, fingerprint.sketch) >= self.min_similarity)
+        )
+
+    def check(self, fingerprint, exact_scopes=(), near_scopes=(), now=None):
+        """Return True if the fingerprint should be rejected.
+
+        Any exact repeat within `exact_scopes` rejects; within `near_scopes`
+        it takes `near_hits` exact or similar recent fingerprints. Accepted
+        fingerprints are recorded in every scope. Rejected ones are not, so a
+        repeat cannot keep its own window alive, except for new variants of a
+        near-duplicate: two edits of a flood are less alike than either is to
+        the original, so the room has to remember each variant to catch the
+        next one.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            exact_buckets = [self._bucket(scope, now) for scope in exact_scopes]
+            near_buckets = [self._bucket(scope, now) for scope in near_scopes]
+            if any(self._exact_match(bucket, fingerprint) for bucket in exact_buckets):
+                return True
+            entry = (now, fingerprint.exact, fingerprint.sketch)
+            flooded = [bucket for bucket in near_buckets if self._near_hits(bucket, fingerprint) >= self.near_hits]
+            if flooded:
+                for bucket in flooded:
+                    bucket.append(entry)
+                return True
+            for bucket in exact_buckets + near_buckets:
+                bucket.append(entry)
+            return False
+
+    def clear(self):
+        with self._lock:
+            self._scopes.clear()
+
+
+index = FingerprintIndex()
+
+
+def scopes_for(fingerprint, user_id, room_id):
+    """Return the (exact_scopes, near_scopes) a message is checked against.
+
+    - the same user repeating themselves in the same room, any length
+    - the same user pasting one long message into several rooms
+    - different users posting (nearly) the same long message in a room
+    Short bodies ("ok", "thanks") only ever meet the first one.
+    """
+    exact_scopes = [('user', user_id, room_id)]
+    near_scopes = []
+    if fingerprint.sketch is not None:
+        exact_scopes.append(('user', user_id))
+        near_scopes.append(('room', room_id))
+    return exact_scopes, near_scopes
+
+
+def is_duplicate(user, room, body):
+    """Check a message body for `user` posting in `room` before it is saved."""
+    if not get_setting('ENABLED'):
+        return False
+
+    fingerprint = Fingerprint(body)
+    exact_scopes, near_scopes = scopes_for(fingerprint, user.pk, room.pk)
+    return index.check(fingerprint, exact_scopes, near_scopes)
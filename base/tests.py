@@ -1,3 +1,467 @@
-from django.test import TestCase
+from importlib import import_module
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
 # Create your tests here.
+
+from . import sharding, spam
+from .formatting import WelcomeTemplate, compile_welcome, render_body, validate_welcome_message
+from .models import Message, MessageQuerySet, Room, Topic, User, UserProfileSummary
+from .spam import Fingerprint, FingerprintIndex, similarity
+
+
+FOLLOW_UPS = [
+    ('can someone help me with question 3 of the homework',
+     'can someone help me with question 4 of the homework'),
+    ('does anyone have the notes from the last lecture',
+     'does anyone have the slides from the last lecture'),
+    ('lets meet at the library at 5 pm tomorrow',
+     'lets meet at the library at 6 pm tomorrow'),
+]
+
+LONG = 'join my discord server for free exam answers and cheap homework help now'
+
+# LONG with one word swapped, at the start, in the middle and at the end
+EDITED = [
+    'come my discord server for free exam answers and cheap homework help now',
+    'join my discord server for free quiz answers and cheap homework help now',
+    'join my discord server for free exam answers and cheap homework help today',
+]
+
+
+class FingerprintTests(SimpleTestCase):
+
+    def test_normalizes_case_punctuation_and_whitespace(self):
+        a = Fingerprint('Hello,   WORLD!!  how are you')
+        b = Fingerprint('hello world how are you?')
+        self.assertEqual(a.exact, b.exact)
+        self.assertEqual(a.sketch, b.sketch)
+
+    def test_short_bodies_have_no_sketch(self):
+        self.assertIsNone(Fingerprint('thanks').sketch)
+        self.assertIsNone(Fingerprint('').sketch)
+        self.assertIsNotNone(Fingerprint(LONG).sketch)
+
+    def test_one_word_edit_of_a_flood_is_a_near_duplicate(self):
+        for body in EDITED:
+            score = similarity(Fingerprint(LONG).sketch, Fingerprint(body).sketch)
+            self.assertGreaterEqual(score, spam.DEFAULTS['MIN_SIMILARITY'], body)
+
+    def test_one_word_follow_ups_are_not_near_duplicates(self):
+        for a, b in FOLLOW_UPS:
+            score = similarity(Fingerprint(a).sketch, Fingerprint(b).sketch)
+            self.assertLess(score, spam.DEFAULTS['MIN_SIMILARITY'], (a, b))
+
+    def test_long_bodies_are_compared_on_a_bounded_sketch(self):
+        words = [f'word{i}' for i in range(40)]
+        sketch = Fingerprint(' '.join(words)).sketch
+        self.assertEqual(len(sketch), spam.SKETCH_SIZE)
+        self.assertEqual(similarity(sketch, sketch), 1)
+        words[20] = 'edited'
+        self.assertGreater(similarity(sketch, Fingerprint(' '.join(words)).sketch), 0.8)
+
+
+class FingerprintIndexTests(SimpleTestCase):
+
+    def test_exact_repeat_is_rejected_inside_the_window_only(self):
+        index = FingerprintIndex(window=120)
+        fingerprint = Fingerprint('hello')
+        self.assertFalse(index.check(fingerprint, [('user', 1, 1)], now=0))
+        self.assertTrue(index.check(fingerprint, [('user', 1, 1)], now=100))
+        # The rejected repeat at 100 did not extend the window
+        self.assertFalse(index.check(fingerprint, [('user', 1, 1)], now=121))
+
+    def test_scopes_are_independent(self):
+        index = FingerprintIndex()
+        fingerprint = Fingerprint('thanks')
+        self.assertFalse(index.check(fingerprint, [('user', 1, 1)], now=0))
+        self.assertFalse(index.check(fingerprint, [('user', 1, 2)], now=1))
+
+    def test_least_recently_used_scope_is_evicted(self):
+        index = FingerprintIndex(max_scopes=2)
+        fingerprint = Fingerprint('hello')
+        index.check(fingerprint, ['a'], now=0)
+        index.check(fingerprint, ['b'], now=0)
+        index.check(fingerprint, ['a'], now=1)  # touches 'a'
+        index.check(fingerprint, ['c'], now=2)  # evicts 'b'
+        self.assertTrue(index.check(fingerprint, ['a'], now=3))
+        self.assertFalse(index.check(fingerprint, ['b'], now=3))
+
+    def test_bucket_keeps_only_the_latest_fingerprints(self):
+        index = FingerprintIndex(per_scope=2)
+        for body in ('one', 'two', 'three'):
+            self.assertFalse(index.check(Fingerprint(body), ['a'], now=0))
+        self.assertFalse(index.check(Fingerprint('one'), ['a'], now=0))
+        self.assertTrue(index.check(Fingerprint('three'), ['a'], now=0))
+
+    def test_near_scope_needs_repeated_hits(self):
+        index = FingerprintIndex(near_hits=2)
+        fingerprint = Fingerprint(LONG)
+        self.assertFalse(index.check(fingerprint, near_scopes=['room'], now=0))
+        self.assertFalse(index.check(fingerprint, near_scopes=['room'], now=1))
+        self.assertTrue(index.check(fingerprint, near_scopes=['room'], now=2))
+
+    def test_rejected_variants_are_remembered_by_the_room(self):
+        index = FingerprintIndex(near_hits=2)
+        index.check(Fingerprint(LONG), near_scopes=['room'], now=0)
+        index.check(Fingerprint(LONG), near_scopes=['room'], now=1)
+        for now, body in enumerate(EDITED, 2):
+            self.assertTrue(index.check(Fingerprint(body), near_scopes=['room'], now=now), body)
+        # Two words away from LONG is too far, but it is one word away from
+        # two of the rejected variants the room remembered
+        variant = 'join my discord server for free quiz answers and cheap homework help today'
+        self.assertLess(similarity(Fingerprint(LONG).sketch, Fingerprint(variant).sketch), index.min_similarity)
+        self.assertTrue(index.check(Fingerprint(variant), near_scopes=['room'], now=10))
+
+
+class RoomMessageFilterTests(TestCase):
+
+    def setUp(self):
+        spam.index.clear()
+        self.user = User.objects.create(username='alice', email='alice@example.com')
+        self.other = User.objects.create(username='bob', email='bob@example.com')
+        self.rooms = [Room.objects.create(host=self.user, name=f'room {i}') for i in range(4)]
+        self.client.force_login(self.user)
+
+    def post(self, room, body):
+        return self.client.post(reverse('room', args=[room.id]), {'body': body}, follow=True)
+
+    def bodies(self, user=None):
+        return list(
+            Message.objects.filter(user=user or self.user, is_bot=False).order_by('id').values_list('body', flat=True)
+        )
+
+    def test_repeat_in_the_same_room_is_rejected(self):
+        self.post(self.rooms[0], 'hello everyone')
+        response = self.post(self.rooms[0], 'Hello everyone!')
+        self.assertEqual(self.bodies(), ['hello everyone'])
+        self.assertContains(response, 'Duplicate message')
+
+    def test_short_replies_in_different_rooms_are_accepted(self):
+        self.post(self.rooms[0], 'thanks')
+        self.post(self.rooms[1], 'thanks')
+        self.assertEqual(self.bodies(), ['thanks', 'thanks'])
+
+    def test_follow_ups_in_different_rooms_are_accepted(self):
+        bodies = [FOLLOW_UPS[0][0], FOLLOW_UPS[0][1], FOLLOW_UPS[1][0], FOLLOW_UPS[1][1]]
+        for room, body in zip(self.rooms, bodies):
+            self.post(room, body)
+        self.assertEqual(self.bodies(), bodies)
+
+    def test_long_message_pasted_into_several_rooms_is_rejected(self):
+        self.post(self.rooms[0], LONG)
+        self.post(self.rooms[1], LONG)
+        self.assertEqual(self.bodies(), [LONG])
+
+    def test_flood_from_several_users_in_one_room_is_rejected(self):
+        users = [self.user, self.other, User.objects.create(username='carol', email='carol@example.com')]
+        for user in users:
+            self.client.force_login(user)
+            self.post(self.rooms[0], LONG)
+        self.assertEqual(Message.objects.filter(body=LONG).count(), 2)
+
+    def test_edited_flood_from_several_users_in_one_room_is_rejected(self):
+        self.post(self.rooms[0], LONG)
+        self.client.force_login(self.other)
+        self.post(self.rooms[0], LONG)
+        for i, body in enumerate(EDITED):
+            self.client.force_login(User.objects.create(username=f'user{i}', email=f'user{i}@example.com'))
+            response = self.post(self.rooms[0], body)
+            self.assertContains(response, 'Duplicate message')
+        self.assertFalse(Message.objects.filter(body__in=EDITED).exists())
+
+    def test_follow_ups_from_several_users_in_one_room_are_accepted(self):
+        users = [self.user, self.other]
+        for a, b in FOLLOW_UPS:
+            for user, body in zip(users, (a, b)):
+                self.client.force_login(user)
+                self.post(self.rooms[0], body)
+        posted = Message.objects.filter(room=self.rooms[0], is_bot=False).values_list('body', flat=True)
+        self.assertEqual(sorted(posted), sorted(body for pair in FOLLOW_UPS for body in pair))
+
+
+class UserProfileSummaryTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='alice', email='alice@example.com')
+        self.topics = [Topic.objects.create(name=f'topic {i}') for i in range(6)]
+        self.rooms = [Room.objects.create(host=self.user, topic=topic, name=topic.name) for topic in self.topics]
+        self.summary = UserProfileSummary.for_user(self.user)
+
+    def post(self, count):
+        return [
+            Message.objects.create(user=self.user, room=self.rooms[i % len(self.rooms)], body=f'message {i}')
+            for i in range(count)
+        ]
+
+    def profile_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('user-profile', args=[self.user.id]))
+        return len(queries)
+
+    def test_summary_follows_message_writes(self):
+        messages = self.post(7)
+        self.summary.refresh_from_db()
+        self.assertEqual(self.summary.message_count, 7)
+        self.assertEqual(self.summary.recent_messages, [m.id for m in reversed(messages)][:5])
+
+        messages[-1].delete()
+        self.summary.refresh_from_db()
+        self.assertEqual(self.summary.message_count, 6)
+        self.assertNotIn(messages[-1].id, self.summary.recent_messages)
+        self.assertEqual(len(self.summary.recent_messages), 5)
+
+    def test_summary_follows_room_writes(self):
+        self.assertEqual(self.summary.rooms_hosted, 6)
+        self.rooms[0].delete()
+        self.summary.refresh_from_db()
+        self.assertEqual(self.summary.rooms_hosted, 5)
+        self.assertNotIn(self.topics[0].id, self.summary.top_topics)
+
+    def test_deleting_a_room_recounts_its_authors_once(self):
+        other = User.objects.create(username='bob', email='bob@example.com')
+        summary = UserProfileSummary.for_user(other)
+        for i in range(3):
+            Message.objects.create(user=other, room=self.rooms[0], body=f'reply {i}')
+        kept = Message.objects.create(user=other, room=self.rooms[1], body='kept')
+        self.post(6)
+
+        self.rooms[0].delete()
+        summary.refresh_from_db()
+        self.assertEqual(summary.message_count, 1)
+        self.assertEqual(summary.recent_messages, [kept.id])
+        self.summary.refresh_from_db()
+        self.assertEqual(self.summary.message_count, 5)
+
+    def test_room_delete_queries_do_not_grow_with_messages(self):
+        def delete_queries(room, count):
+            for i in range(count):
+                Message.objects.create(user=self.user, room=room, body=f'message {i}')
+            with CaptureQueriesContext(connection) as queries:
+                room.delete()
+            return len(queries)
+
+        self.assertEqual(delete_queries(self.rooms[0], 5), delete_queries(self.rooms[1], 500))
+
+    def test_profile_queries_do_not_grow_with_history(self):
+        self.post(5)
+        few = self.profile_queries()
+        self.post(100)
+        self.assertEqual(self.profile_queries(), few)
+
+    def test_sidebar_lists_site_topics_not_only_hosted_ones(self):
+        other = User.objects.create(username='bob', email='bob@example.com')
+        UserProfileSummary.for_user(other)
+        response = self.client.get(reverse('user-profile', args=[other.id]))
+        self.assertEqual(len(response.context['topics']), 5)
+        self.assertEqual(response.context['top_topics'], [])
+
+    def test_concurrent_first_view_reuses_the_existing_summary(self):
+        other = User.objects.create(username='bob', email='bob@example.com')
+        existing = UserProfileSummary.objects.create(user=other)
+        # Simulate losing the race: the lookup misses, the insert collides
+        with mock.patch.object(UserProfileSummary.objects, 'filter') as lookup:
+            lookup.return_value.first.return_value = None
+            summary = UserProfileSummary.for_user(other)
+        self.assertEqual(summary.pk, existing.pk)
+
+
+SHARDS = settings.TEST_MESSAGE_SHARDS
+
+
+@override_settings(MESSAGE_SHARDS=SHARDS, DATABASE_ROUTERS=['base.routers.MessageShardRouter'])
+class ShardingTests(TestCase):
+    databases = {'default', *SHARDS}
+
+    def setUp(self):
+        spam.index.clear()
+        sharding._default_drained = False
+        self.addCleanup(setattr, sharding, '_default_drained', False)
+        for alias in SHARDS:
+            sharding.reserve_id_range(sender=apps.get_app_config('base'), using=alias)
+
+        self.user = User.objects.create(username='alice', email='alice@example.com')
+        self.rooms = [Room.objects.create(host=self.user, name=f'room {i}') for i in range(8)]
+        self.assertEqual({sharding.shard_for_room(room.id) for room in self.rooms}, set(SHARDS))
+
+    def post(self, count, using=None):
+        messages = Message.objects.using(using) if using else Message.objects
+        return [
+            messages.create(user=self.user, room=self.rooms[i % len(self.rooms)], body=f'message {i}')
+            for i in range(count)
+        ]
+
+    def stored(self, alias):
+        return list(Message.objects.using(alias).order_by('body').values_list('room_id', 'body'))
+
+    def test_messages_are_placed_on_their_rooms_shard(self):
+        for message in self.post(8):
+            alias = sharding.shard_for_room(message.room_id)
+            self.assertEqual(message._state.db, alias)
+            self.assertTrue(Message.objects.using(alias).filter(pk=message.pk).exists())
+            self.assertEqual(message.room.message_set.get(), message)
+            # Ids come from the shard's own range
+            self.assertEqual(message.id >> sharding.ID_RANGE_BITS, SHARDS.index(alias) + 1)
+        self.assertFalse(Message.objects.using('default').exists())
+
+    def test_reserve_id_range_never_moves_a_sequence_back(self):
+        first = self.post(8)
+        for alias in SHARDS:
+            sharding.reserve_id_range(sender=apps.get_app_config('base'), using=alias)
+        second = self.post(8)
+        self.assertGreater(min(m.id for m in second if m._state.db == SHARDS[0]),
+                           max(m.id for m in first if m._state.db == SHARDS[0]))
+
+    def test_scatter_merges_shards_in_order(self):
+        messages = self.post(12)
+        newest_first = [message.id for message in reversed(messages)]
+        self.assertEqual([m.id for m in sharding.scatter(Message.objects.all())], newest_first)
+        self.assertEqual([m.id for m in sharding.scatter(Message.objects.all(), limit=5)], newest_first[:5])
+
+        rooms = [self.rooms[0].id, self.rooms[1].id]
+        expected = [message.id for message in reversed(messages) if message.room_id in rooms]
+        self.assertEqual([m.id for m in sharding.messages_for_rooms(rooms)], expected)
+        self.assertEqual(sharding.count(Message.objects.all()), 12)
+
+    def test_get_message_asks_the_id_range_owner_first(self):
+        messages = self.post(8)
+        sharding.has_unrebalanced_messages()
+        for message in messages:
+            with self.assertNumQueries(1, using=message._state.db):
+                self.assertEqual(sharding.get_message(message.id), message)
+        with self.assertRaises(Message.DoesNotExist):
+            sharding.get_message(1 << 50)
+
+    def test_deleting_a_room_deletes_its_messages_on_the_shard(self):
+        self.post(16)
+        room = self.rooms[0]
+        alias = sharding.shard_for_room(room.id)
+        room.delete()
+        self.assertFalse(Message.objects.using(alias).filter(room_id=room.id).exists())
+        self.assertEqual(sharding.count(Message.objects.all()), 14)
+
+    def test_deleting_a_user_deletes_their_messages_on_every_shard(self):
+        other = User.objects.create(username='bob', email='bob@example.com')
+        self.post(8)
+        for room in self.rooms:
+            Message.objects.create(user=other, room=room, body='reply')
+        other.delete()
+        for alias in SHARDS:
+            self.assertFalse(Message.objects.using(alias).filter(user_id=other.id).exists())
+        self.assertEqual(sharding.count(Message.objects.all()), 8)
+
+    def test_unrebalanced_messages_stay_readable_until_moved(self):
+        legacy = self.post(8, using='default')
+        self.assertEqual(len(sharding.scatter(Message.objects.all())), 8)
+        self.assertEqual(sharding.get_message(legacy[0].id).body, legacy[0].body)
+
+        call_command('rebalance_messages', stdout=StringIO())
+        self.assertFalse(Message.objects.using('default').exists())
+        for message in legacy:
+            moved = Message.objects.using(sharding.shard_for_room(message.room_id)).get(body=message.body)
+            self.assertEqual((moved.user_id, moved.created), (message.user_id, message.created))
+        self.assertEqual(len(sharding.scatter(Message.objects.all())), 8)
+
+    def test_rebalance_rerun_after_a_failed_delete_does_not_duplicate(self):
+        legacy = self.post(8, using='default')
+        expected = sorted((message.room_id, message.body) for message in legacy)
+
+        # Copies committed, source rows not yet deleted
+        with mock.patch.object(MessageQuerySet, 'delete', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                call_command('rebalance_messages', stdout=StringIO())
+        self.assertTrue(any(self.stored(alias) for alias in SHARDS))
+
+        call_command('rebalance_messages', stdout=StringIO())
+        call_command('rebalance_messages', stdout=StringIO())
+        self.assertFalse(Message.objects.using('default').exists())
+        self.assertEqual(sorted(self.stored(SHARDS[0]) + self.stored(SHARDS[1])), expected)
+
+    def test_greetings_from_before_the_rebalance_are_not_repeated(self):
+        room = self.rooms[0]
+        chatbot = User.objects.create(username='ChatBot', email='chatbot@example.com')
+        Message.objects.using('default').create(user=chatbot, room=room, body=room.render_welcome(self.user), is_bot=True)
+        self.client.force_login(self.user)
+        self.client.get(reverse('room', args=[room.id]))
+        self.assertFalse(Message.objects.using(sharding.shard_for_room(room.id)).filter(is_bot=True).exists())
+
+
+class FormattingTests(SimpleTestCase):
+
+    def test_render_body_escapes_html(self):
+        self.assertEqual(render_body('<script>alert("hi")</script> & more'),
+                         '&lt;script&gt;alert(&quot;hi&quot;)&lt;/script&gt; &amp; more')
+
+    def test_render_body_links_urls_and_emails(self):
+        html = render_body('slides at https://example.com/a?b=1&c=2 or mail bob@example.com')
+        self.assertIn('<a href="https://example.com/a?b=1&amp;c=2" rel="nofollow">https://example.com/a?b=1&amp;c=2</a>', html)
+        self.assertIn('<a href="mailto:bob@example.com">bob@example.com</a>', html)
+
+    def test_render_body_keeps_line_breaks(self):
+        self.assertEqual(render_body('one\r\ntwo\rthree\nfour'), 'one<br>two<br>three<br>four')
+        self.assertEqual(render_body(None), '')
+
+    def test_welcome_message_placeholders_are_validated(self):
+        validate_welcome_message('Welcome {user} to {room}! {} and {two words} are text')
+        with self.assertRaisesMessage(ValidationError, '{name}, {topic}'):
+            validate_welcome_message('Hi {name}, welcome to {room} about {topic}')
+
+    def test_welcome_template_fills_placeholders_only(self):
+        template = WelcomeTemplate('{user}, welcome to {room}. Ask {user} about {this}')
+        self.assertEqual(template.render('alice', 'Django'), 'alice, welcome to Django. Ask alice about {this}')
+        self.assertEqual(WelcomeTemplate('').render('alice', 'Django'), '')
+        self.assertIs(compile_welcome('Hi {user}'), compile_welcome('Hi {user}'))
+
+
+class MessageRenderingTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='alice', email='alice@example.com')
+        self.room = Room.objects.create(host=self.user, name='<b>room</b>', welcome_message='Hi {user}, this is {room}')
+
+    def test_save_keeps_body_html_in_step(self):
+        message = Message.objects.create(user=self.user, room=self.room, body='see <https://example.com>')
+        self.assertEqual(message.rendered_body, render_body(message.body))
+        message.body = 'edited\nbody'
+        message.save(update_fields=['body'])
+        message.refresh_from_db()
+        self.assertEqual(message.rendered_body, 'edited<br>body')
+
+    def test_writes_around_save_cannot_leave_stale_html(self):
+        message = Message.objects.create(user=self.user, room=self.room, body='old')
+        with self.assertRaises(ValueError):
+            Message.objects.filter(pk=message.pk).update(body='new')
+        message.body = 'new'
+        with self.assertRaises(ValueError):
+            Message.objects.bulk_update([message], ['body'])
+        created = Message.objects.bulk_create([Message(user=self.user, room=self.room, body='a & b')])
+        self.assertEqual(Message.objects.get(pk=created[0].pk).body_html, 'a &amp; b')
+
+    def test_welcome_is_stored_as_text_and_escaped_once(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('room', args=[self.room.id]))
+        greeting = Message.objects.get(is_bot=True)
+        self.assertEqual(greeting.body, 'Hi alice, this is <b>room</b>')
+        self.assertContains(response, 'Hi alice, this is &lt;b&gt;room&lt;/b&gt;')
+
+    def test_migration_renders_existing_bodies(self):
+        migration = import_module('base.migrations.0007_message_body_html_alter_room_welcome_message')
+        Message.objects.bulk_create(
+            Message(user=self.user, room=self.room, body=f'message {i}\n<{i}>') for i in range(1001)
+        )
+        Message.objects.update(body_html='')
+
+        migration.render_existing_bodies(apps, SimpleNamespace(connection=connection))
+        self.assertFalse(Message.objects.filter(body_html='').exists())
+        message = Message.objects.get(body='message 1000\n<1000>')
+        self.assertEqual(message.body_html, 'message 1000<br>&lt;1000&gt;')
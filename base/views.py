@@ -4,11 +4,17 @@ from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q
-from .models import Room, Topic, Message, User
+from django.db.models import Q, Count
+from .models import Room, Topic, Message, User, UserProfileSummary
 from .forms import RoomForm, UserForm, MyUserCreationForm
+from .spam import is_duplicate
+from . import sharding
 
 # Create your views here.
+
+# Rooms listed on a profile page; the full count is in the profile summary
+PROFILE_ROOMS = 20
+
 # rooms = [
 #     {"id": "1", "name": "Python"},
 #     {"id": "2", "name": "Django"},
@@ -75,10 +81,12 @@ def home(request):
         Q(description__icontains=q)
         )
     
-    topics = Topic.objects.all()[0:5]
+    topics = Topic.objects.annotate(room_count=Count('room'))[0:5]
     room_count = rooms.count()
     # for recent activities, we're getting messages from here
-    room_messages = Message.objects.filter(Q(room__topic__name__icontains=q))
+    # (rooms are looked up first since messages may live in another database)
+    room_ids = Room.objects.filter(topic__name__icontains=q).values_list('id', flat=True)
+    room_messages = sharding.messages_for_rooms(room_ids)
     
     context = {"rooms": rooms, "topics": topics, "room_count": room_count, "room_messages": room_messages}
     # Rendering the html page from templates
@@ -87,7 +95,7 @@ def home(request):
 # Rahul
 def room(request, pk):
     room = Room.objects.get(id=pk)
-    room_messages = room.message_set.all().order_by('-created')
+    room_messages = sharding.scatter(room.message_set.all().order_by('-created'), aliases=sharding.room_aliases(room.id))
     participants = room.participants.all()
 
     # Greet user if they just joined and haven't been greeted yet
@@ -96,13 +104,19 @@ def room(request, pk):
         chatbot_user, created = User.objects.get_or_create(username='ChatBot')
 
         # Avoid duplicate greetings
-        already_greeted = room.message_set.filter(
+        greetings = room.message_set.filter(
             is_bot=True,
             body__icontains=request.user.username
-        ).exists()
+        )
+        # With sharding on, greetings from before the rebalance are still in default
+        aliases = sharding.room_aliases(room.id)
+        if aliases:
+            already_greeted = any(greetings.using(alias).exists() for alias in aliases)
+        else:
+            already_greeted = greetings.exists()
 
         if not already_greeted:
-            greeting = room.welcome_message.replace("{user}", request.user.username).replace("{room}", room.name)
+            greeting = room.render_welcome(request.user)
             Message.objects.create(
                 user=chatbot_user,  
                 room=room,
@@ -112,10 +126,16 @@ def room(request, pk):
 
     
     if request.method == 'POST':
+        body = request.POST.get('body')
+        # Reject repeated / flooded bodies before anything is written
+        if is_duplicate(request.user, room, body):
+            messages.error(request, 'Duplicate message, please wait before posting it again')
+            return redirect('room', pk=room.id)
+
         message = Message.objects.create(
             user = request.user,
             room = room,
-            body = request.POST.get('body')
+            body = body
         )
         room.participants.add(request.user)
         return redirect('room', pk=room.id)
@@ -126,10 +146,17 @@ def room(request, pk):
 
 def userProfile(request, pk):
     user = User.objects.get(id=pk)
-    rooms = user.room_set.all()
-    room_messages = user.message_set.all()
-    topics = Topic.objects.all()
-    context = {'user': user, 'rooms': rooms, 'room_messages': room_messages, 'topics': topics}
+    # Counts, top topics and recent activity come from the precomputed summary,
+    # so the number of queries doesn't grow with the user's history
+    summary = UserProfileSummary.for_user(user)
+    rooms = user.room_set.select_related('host', 'topic').prefetch_related('participants')[0:PROFILE_ROOMS]
+    room_messages = sharding.scatter(
+        Message.objects.filter(id__in=summary.recent_messages).select_related('user', 'room')
+    )
+    topics = Topic.objects.annotate(room_count=Count('room'))[0:5]
+    top_topics = sorted(Topic.objects.filter(id__in=summary.top_topics), key=lambda t: summary.top_topics.index(t.id))
+    context = {'user': user, 'summary': summary, 'rooms': rooms, 'room_messages': room_messages,
+               'topics': topics, 'top_topics': top_topics}
     return render(request, 'base/profile.html', context)
 
 @login_required(login_url="login")
@@ -187,7 +214,7 @@ def deleteRoom(request, pk):
 
 @login_required(login_url="login")
 def deleteMessage(request, pk):
-    message = Message.objects.get(id=pk)
+    message = sharding.get_message(pk)
     if request.user != message.user:
         return HttpResponse('Unauthorized to update this room')
     
@@ -220,5 +247,5 @@ def topicsPage(request):
 
 
 def activityPage(request):
-    room_messages = Message.objects.all()[0:5]
+    room_messages = sharding.scatter(Message.objects.all(), limit=5)
     return render(request, 'base/activity.html', {'room_messages': room_messages})
\ No newline at end of file
@@ -0,0 +1,69 @@
+# Worker warm-up: do the one-off work of the first request (template
+# compilation, URLconf import, database connect) before traffic arrives.
+#
+# study_bud/wsgi.py and asgi.py warm templates and URLs at import when
+# settings.WARMUP is on. Database connections are per thread and can't cross
+# a fork, so they're opened per worker instead, from gunicorn.conf.py's
+# post_worker_init hook. `python manage.py warmup` runs every step.
+
+import time
+from pathlib import Path
+
+from django.db import connections
+from django.template import engines
+from django.urls import get_resolver
+
+
+def template_names(engine):
+    # Same directories the autoreloader watches: whatever the loaders
+    # (filesystem, app_directories, wrapped by cached) search
+    names = set()
+    for loader in engine.engine.template_loaders:
+        for directory in loader.get_dirs() if hasattr(loader, 'get_dirs') else []:
+            directory = Path(directory)
+            if directory.is_dir():
+                names.update(path.relative_to(directory).as_posix() for path in directory.rglob('*.html'))
+    return sorted(names)
+
+
+def warm_templates():
+    # Django's default (cached) loader keeps the compiled templates in memory,
+    # so later renders (including {% extends %} / {% include %}) skip parsing
+    count = 0
+    for engine in engines.all():
+        for name in template_names(engine):
+            engine.get_template(name)
+            count += 1
+    return count
+
+
+def warm_urls():
+    # Imports every view module (DRF included); reading reverse_dict makes the
+    # resolver build its reverse lookup
+    return len(get_resolver().reverse_dict)
+
+
+def warm_databases():
+    # Opens connections for the calling thread only
+    for alias in connections:
+        connections[alias].ensure_connection()
+    return len(connections.all())
+
+
+STEPS = [
+    ('templates', warm_templates),
+    ('urls', warm_urls),
+    ('databases', warm_databases),
+]
+
+
+def warm_up(databases=True):
+    """Run the warm-up steps; returns [(step, count, seconds), ...]."""
+    timings = []
+    for name, step in STEPS:
+        if name == 'databases' and not databases:
+            continue
+        start = time.perf_counter()
+        count = step()
+        timings.append((name, count, time.perf_counter() - start))
+    return timings
@@ -0,0 +1,12 @@
+# Picked up automatically by `gunicorn study_bud.wsgi` run from this folder.
+
+
+def post_worker_init(worker):
+    # Templates and URLs are warmed when study_bud.wsgi is imported; database
+    # connections are opened here, inside each worker after the fork, so
+    # they're never shared between processes (safe with --preload). Sync
+    # workers serve requests on this same thread and keep using them for
+    # CONN_MAX_AGE seconds.
+    from base.warmup import warm_databases
+
+    warm_databases()
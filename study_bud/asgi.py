@@ -14,3 +14,11 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'study_bud.settings')
 
 application = get_asgi_application()
+
+from django.conf import settings  # noqa: E402
+
+if settings.WARMUP:
+    from base.warmup import warm_up
+
+    # Databases are warmed per worker, see gunicorn.conf.py
+    warm_up(databases=False)
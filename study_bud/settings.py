@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -84,13 +86,45 @@ WSGI_APPLICATION = 'study_bud.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# Connections are kept for a minute so the ones opened by the worker warm-up
+# (and by earlier requests) get reused instead of reconnecting per request
+CONN_MAX_AGE = int(os.environ.get('CONN_MAX_AGE', '60'))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': CONN_MAX_AGE,
     }
 }
 
+# Optional sharding of messages by room across several databases, e.g.
+# MESSAGE_SHARDS=4. Each shard needs `python manage.py migrate --database
+# messages_N`, then `python manage.py rebalance_messages` moves existing rows
+# out of default (they stay readable from there until it has run).
+MESSAGE_SHARDS = [f'messages_{i}' for i in range(int(os.environ.get('MESSAGE_SHARDS', '0')))]
+
+for alias in MESSAGE_SHARDS:
+    DATABASES[alias] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / f'{alias}.sqlite3',
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+    }
+
+if MESSAGE_SHARDS:
+    DATABASE_ROUTERS = ['base.routers.MessageShardRouter']
+
+# Two spare databases for the sharding tests (base/tests.py), which turn
+# sharding on for themselves with override_settings
+TEST_MESSAGE_SHARDS = ['test_messages_0', 'test_messages_1']
+
+if sys.argv[1:2] == ['test']:
+    for alias in TEST_MESSAGE_SHARDS:
+        DATABASES[alias] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / f'{alias}.sqlite3',
+        }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -143,4 +177,15 @@ MEDIA_ROOT = BASE_DIR / 'static/images'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-CORS_ALLOW_ALL_ORIGINS = True
\ No newline at end of file
+CORS_ALLOW_ALL_ORIGINS = True
+
+# Duplicate / flood filter for room messages, see base/spam.py for the defaults
+SPAM_FILTER = {
+    'ENABLED': True,
+    'WINDOW_SECONDS': 120,
+}
+
+# Precompile templates and load the URLconf when the WSGI/ASGI application is
+# created, before the worker takes requests (database connections are opened
+# per worker by gunicorn.conf.py)
+WARMUP = os.environ.get('WARMUP', '1') == '1'